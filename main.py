@@ -1,10 +1,36 @@
+import builtins
+import importlib.util
 import logging
-
-from copy import deepcopy
+import os
+import re
+import sys
+
+from array import array
+from collections import deque
+from functools import lru_cache
+from itertools import product
 from rich import print
 
+# numba (and numpy) are optional and slow to import, so they're only loaded the first
+# time an NFA is big enough to use the jitted subset construction
+HAVE_NUMBA = importlib.util.find_spec("numba") is not None
+
+
+# whether reprs carry rich markup, turned off for plain (non-interactive) output
+MARKUP = True
+
+
+def styled(text, style):
+    return f"[{style}]{text}[/{style}]" if MARKUP else text
 
 
+def bits(mask):
+    """Indexes of the set bits in an int bitmask, lowest first"""
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
 
 class Transition:
     def __init__(self, on, source, dest):
@@ -19,16 +45,117 @@ class Transition:
     def __repr__(self):
         return f"{self.node_str(self.source)} --('{self.on}')--> {self.node_str(self.dest)}"
 
-class FiniteAutomaton:
+def _subset_construct_loop(table, label_order, start):
+    """Subset construction BFS over int64 node bitmasks, compiled by _jit_subset_construct_loop
+
+    table[n, on] is the mask of nodes reached from node n on label id on (closure included).
+    Returns states in discovery order and the (source, label id, dest) edges between them.
+    """
+    n_nodes = table.shape[0]
+    index = {start: 0}
+    states = [start]
+    sources = []
+    ons = []
+    dests = []
+
+    head = 0
+    while head < len(states):
+        current = states[head]
+        # set bits gathered once per state, not once per label
+        nodes = [n for n in range(n_nodes) if (current >> n) & 1]
+        for on in label_order:
+            target = 0
+            for n in nodes:
+                target |= table[n, on]
+
+            if target == 0:
+                continue
+
+            if target in index:
+                dest = index[target]
+            else:
+                dest = len(states)
+                index[target] = dest
+                states.append(target)
+
+            sources.append(head)
+            ons.append(on)
+            dests.append(dest)
+
+        head += 1
 
-    def copy(self):
-        return deepcopy(self)
+    return states, sources, ons, dests
+
+
+@lru_cache(maxsize=None)
+def _jit_subset_construct_loop():
+    import numba
+    return numba.njit(cache=True)(_subset_construct_loop)
+
+
+class FiniteAutomaton:
+    """Transitions are stored as parallel arrays (label id, source, dest), one entry per edge
+
+    Labels are interned per automaton: `alphabet` maps char -> id and `labels` maps id -> char,
+    with id 0 always being the epsilon label ''.
+    """
+
+    def set_transitions(self, transitions):
+        self.alphabet = {'': 0}
+        self.labels = ['']
+        self.on = array('H', (self.label_id(t.on) for t in transitions))
+        self.src = array('i', (t.source for t in transitions))
+        self.dst = array('i', (t.dest for t in transitions))
+        self.invalidate()
+
+    def invalidate(self):
+        """Drop cached indexes, must be called after any change to the transitions"""
+        self._adj = None
+        self._eps_closure = None
+        self._eps_mask = None
+
+    @property
+    def transitions(self):
+        # read-only view, used for printing/graphviz
+        labels = self.labels
+        return [Transition(labels[on], source, dest) for on, source, dest in zip(self.on, self.src, self.dst)]
+
+    def label_id(self, on):
+        """Id for label char, interning it if new"""
+        oid = self.alphabet.setdefault(on, len(self.labels))
+        if oid == len(self.labels):
+            self.labels.append(on)
+        return oid
+
+    def add_transition(self, on, source, dest):
+        self.on.append(self.label_id(on))
+        self.src.append(source)
+        self.dst.append(dest)
+        self.invalidate()
+
+    def extend(self, other):
+        # other has its own alphabet, so map its label ids into ours
+        ids = [self.label_id(c) for c in other.labels]
+        self.on.extend(ids[oid] for oid in other.on)
+        self.src.extend(other.src)
+        self.dst.extend(other.dst)
+        self.invalidate()
+
+    def adjacency(self):
+        """Source node -> list of (label id, dest), built lazily and dropped on any mutation"""
+        if self._adj is None:
+            adj = {}
+            for on, source, dest in zip(self.on, self.src, self.dst):
+                adj.setdefault(source, []).append((on, dest))
+            self._adj = adj
+
+        return self._adj
 
     def max_node(self):
-        return max((max(t.source,t.dest) for t in self.transitions))
+        return max(max(self.src), max(self.dst))
 
     def min_node(self):
-        return min((min(t.source,t.dest) for t in self.transitions))
+        return min(min(self.src), min(self.dst))
 
     def __repr__(self):
         t_strings = "\n".join(
@@ -37,17 +164,14 @@ class FiniteAutomaton:
 
         return f"START: {self.start}   TERM: {self.term}\n{t_strings}"
 
-    def to_graphviz(self, title=""):
-        t_strings = "\n".join(
-            (f"{t.source} -> {t.dest} [ label = \"{t.on if t.on else 'ε'}\" ];" for t in self.transitions)
-        )
-
-        if hasattr(self.term, '__iter__'):
+    def graphviz_parts(self, title=""):
+        """Graphviz source as a list of strings, suitable for writelines()"""
+        if isinstance(self.term, (list, tuple, set, frozenset)):
             term_string = ' '.join((f'{n}' for n in self.term))
         else:
             term_string = f'{self.term}'
 
-        return (
+        parts = [
             f'digraph finite_state_machine {{\n'
             f'labelloc="t";'
             f'label="{title}";'
@@ -55,221 +179,471 @@ class FiniteAutomaton:
             f'    size="8,5"\n'
             f'    node [shape = doublecircle]; {self.start} {term_string};\n'
             f'    node [shape = circle];\n'
-            f'    {t_strings}\n'
-            f'}}'
-        )
+            f'    '
+        ]
+        append = parts.append
+        labels = self.labels
+        for on, source, dest in zip(self.on, self.src, self.dst):
+            append(f"{source} -> {dest} [ label = \"{labels[on] or 'ε'}\" ];\n")
+        append('}')
+
+        return parts
+
+    def to_graphviz(self, title=""):
+        return ''.join(self.graphviz_parts(title))
 
 class DFA(FiniteAutomaton):
     """Deterministic finite automoton"""
     def __init__(self, transitions=None, start=-1, term=None):
-        self.transitions = transitions or []
+        self.set_transitions(transitions or [])
         self.start = start
         self.term = term or []
-    
+
+    # above this many states the generated matcher looks up a transition table
+    # instead of dispatching on state with an if/elif chain
+    COMPILE_CHAIN_MAX_STATES = 16
+
+    def compile_source(self):
+        """Python source for a `match(s)` function that tests if s is accepted"""
+        table = {}
+        labels = self.labels
+        for on, source, dest in zip(self.on, self.src, self.dst):
+            table.setdefault(source, {})[labels[on]] = dest
+
+        lines = [
+            "def match(s):",
+            f"    state = {self.start}",
+            "    for c in s:",
+        ]
+
+        if len(table) > self.COMPILE_CHAIN_MAX_STATES:
+            lines[:0] = [f"T = {table!r}", ""]
+            lines += [
+                "        moves = T.get(state)",
+                "        if moves is None or c not in moves:",
+                "            return False",
+                "        state = moves[c]",
+            ]
+        else:
+            keyword = "if"
+            for state, moves in sorted(table.items()):
+                lines.append(f"        {keyword} state == {state}:")
+                keyword = "elif"
+
+                c_keyword = "if"
+                for c, dest in sorted(moves.items()):
+                    lines.append(f"            {c_keyword} c == {c!r}:")
+                    lines.append(f"                state = {dest}")
+                    c_keyword = "elif"
+                lines.append("            else:")
+                lines.append("                return False")
+
+            if table:
+                lines.append("        else:")
+                lines.append("            return False")
+            else:
+                lines.append("        return False")
+
+        # a set literal in an `in` test is folded to a frozenset constant at compile time
+        term = ", ".join(str(n) for n in sorted(set(self.term)))
+        lines.append(f"    return state in {{{term}}}" if term else "    return False")
+
+        return "\n".join(lines) + "\n"
+
+    def compile(self):
+        """Generate and exec a matcher function specialized to this DFA"""
+        namespace = {}
+        exec(self.compile_source(), namespace)
+        return namespace["match"]
+
+    def minimize(self):
+        """Equivalent DFA with the fewest states, using Hopcroft's partition refinement
+
+        Missing transitions go to an implicit dead state, which is dropped again (along
+        with anything equivalent to it) when the minimized DFA is built.
+        """
+        dead = max(max(self.src, default=0), max(self.dst, default=0), self.start, *self.term) + 1
+        states = set(self.src) | set(self.dst) | set(self.term) | {self.start, dead}
+
+        # predecessors by label id: inverse[on][dest] = {sources}
+        delta = {(source, on): dest for on, source, dest in zip(self.on, self.src, self.dst)}
+        alphabet = range(1, len(self.labels))
+        inverse = {on: {} for on in alphabet}
+        for on in alphabet:
+            preds = inverse[on]
+            for state in states:
+                preds.setdefault(delta.get((state, on), dead), set()).add(state)
+
+        accepting = set(self.term)
+        blocks = [b for b in (accepting, states - accepting) if b]
+        block_of = {state: i for i, b in enumerate(blocks) for state in b}
+        work = set(range(len(blocks)))
+
+        while work:
+            splitter = blocks[work.pop()]
+            for on in alphabet:
+                preds = inverse[on]
+                x = set()
+                for state in splitter:
+                    x.update(preds.get(state, ()))
+
+                touched = {}
+                for state in x:
+                    touched.setdefault(block_of[state], set()).add(state)
+
+                for i, inside in touched.items():
+                    block = blocks[i]
+                    if len(inside) == len(block):
+                        continue
+
+                    outside = block - inside
+                    blocks[i] = inside
+                    blocks.append(outside)
+                    j = len(blocks) - 1
+                    for state in outside:
+                        block_of[state] = j
+
+                    if i in work or len(outside) <= len(inside):
+                        work.add(j)
+                    else:
+                        work.add(i)
+
+        # number blocks by their smallest state, skipping the dead block
+        dead_block = block_of[dead]
+        order = sorted((i for i in range(len(blocks)) if i != dead_block), key=lambda i: min(blocks[i]))
+        new_id = {block: n for n, block in enumerate(order)}
+
+        labels = self.labels
+        transitions = []
+        seen = set()
+        for on, source, dest in zip(self.on, self.src, self.dst):
+            edge = (on, new_id.get(block_of[source]), new_id.get(block_of[dest]))
+            if None in edge or edge in seen:
+                continue
+            seen.add(edge)
+            transitions.append(Transition(labels[on], edge[1], edge[2]))
+
+        term = sorted({new_id[block_of[n]] for n in self.term})
+
+        return DFA(transitions, new_id.get(block_of[self.start], 0), term)
+
 
 class NFA(FiniteAutomaton):
     """Nondeterministic finite automoton"""
     def __init__(self, transitions=None, start=-1, term=-1):
-        self.transitions = transitions or []
+        self.set_transitions(transitions or [])
         self.start = start
         self.term = term
 
-    def to_dfa(self):
+    # the numba loop costs ~1.4s to compile on first use (~0.15s from its on-disk cache),
+    # so it's only worth it for NFAs big enough that the BFS itself takes a while
+    JIT_MIN_NODES = 32
+
+    def to_dfa(self, minimize=False):
+        # DFA states are sets of NFA nodes, kept as int bitmasks so union is `|` and
+        # they hash cheaply as dict keys
+        eps_mask = self.eps_closure_masks()
+        term_bit = 1 << self.term
+
+        # per NFA node: label id -> epsilon closure of everything reachable on that label,
+        # so a macro-state's successor on a label is just the OR over its nodes
+        next_mask = {}
+        for on, source, dest in zip(self.on, self.src, self.dst):
+            if on:
+                moves = next_mask.setdefault(source, {})
+                moves[on] = moves.get(on, 0) | eps_mask[dest]
+
+        # int64 masks in the jitted loop, so only for NFAs with up to 63 nodes
+        n_nodes = max(eps_mask) + 1
+        if HAVE_NUMBA and self.JIT_MIN_NODES <= n_nodes <= 63:
+            new_transitions, new_term_states = self._subset_construct_jit(
+                next_mask, n_nodes, eps_mask[self.start], term_bit
+            )
+        else:
+            new_transitions, new_term_states = self._subset_construct(next_mask, eps_mask[self.start], term_bit)
+
+        dfa = DFA(new_transitions, 0, new_term_states)
+
+        return dfa.minimize() if minimize else dfa
+        # start + epsilon closure  ==> new initial state, add to stack
+        # pop state off stack and for each possible char in "transition on" set, get
+        #   epsilon closure of (all states after transition on that char)
+        #   ==> state identified by set of old states
+        # repeat until nothing in stack
+
+    def _subset_construct(self, next_mask, new_initial_state, term_bit):
+        labels = self.labels
         new_states = []
+        state_index = {}
         new_transitions = []
         new_term_states = []
-        queue = []
+        queue = deque()
 
-        new_initial_state = self.epsilon_closure((self.start,))
+        state_index[new_initial_state] = 0
         new_states.append(new_initial_state)
         queue.append(new_initial_state)
 
-        while queue:
-            current_state = queue.pop()
-            for current_on in self.get_moves_for_nodes(current_state):
-                if current_on == '':
-                    continue
+        if new_initial_state & term_bit:
+            new_term_states.append(0)
 
-                possibly_new_state = self.epsilon_closure(self.move_on(current_state, current_on))
-                if possibly_new_state not in new_states:
+        while queue:
+            current_state = queue.popleft()
+            current_index = state_index[current_state]
+
+            moves = {}
+            for n in bits(current_state):
+                for on, mask in next_mask.get(n, {}).items():
+                    moves[on] = moves.get(on, 0) | mask
+
+            # sorted by char so DFA state numbering doesn't depend on dict order
+            for on, possibly_new_state in sorted(moves.items(), key=lambda item: labels[item[0]]):
+                dest_index = state_index.setdefault(possibly_new_state, len(new_states))
+                if dest_index == len(new_states):
                     queue.append(possibly_new_state)
                     new_states.append(possibly_new_state)
 
-                    if self.term in possibly_new_state:
-                        new_term_states.append(len(new_states)-1)
+                    if possibly_new_state & term_bit:
+                        new_term_states.append(dest_index)
 
                 new_transitions.append(
                     Transition(
-                        source=new_states.index(current_state),
-                        dest=new_states.index(possibly_new_state),
-                        on=current_on
+                        source=current_index,
+                        dest=dest_index,
+                        on=labels[on]
                     )
                 )
 
         # for i, s in enumerate(new_states):
         #     print(f"{i}: {s}")
 
-        return DFA(new_transitions, 0, new_term_states)
-        # start + epsilon closure  ==> new initial state, add to stack
-        # pop state off stack and for each possible char in "transition on" set, get
-        #   epsilon closure of (all states after transition on that char)
-        #   ==> state identified by set of old states
-        # repeat until nothing in stack
+        return new_transitions, new_term_states
+
+    def _subset_construct_jit(self, next_mask, n_nodes, new_initial_state, term_bit):
+        """Same as _subset_construct, but with the BFS in numba-compiled _subset_construct_loop"""
+        import numpy as np
+
+        labels = self.labels
+        table = np.zeros((n_nodes, len(labels)), dtype=np.int64)
+        for n, moves in next_mask.items():
+            for on, mask in moves.items():
+                table[n, on] = mask
+
+        label_order = np.array(sorted(range(1, len(labels)), key=labels.__getitem__), dtype=np.int64)
+        subset_construct_loop = _jit_subset_construct_loop()
+        states, sources, ons, dests = subset_construct_loop(table, label_order, np.int64(new_initial_state))
+
+        new_transitions = [
+            Transition(source=source, dest=dest, on=labels[on])
+            for source, on, dest in zip(sources, ons, dests)
+        ]
+        new_term_states = [i for i, state in enumerate(states) if state & term_bit]
+
+        return new_transitions, new_term_states
 
     def nodes(self):
-        return sorted(list( {t.start for t in self.transitions} + {t.term for t in self.transitions} ))
+        return set(self.src) | set(self.dst)
 
     def transitions_from(self, nodes):
-        return [t for t in self.transitions if t.source in nodes]
+        adj = self.adjacency()
+        labels = self.labels
+        return [Transition(labels[on], n, dest) for n in set(nodes) for on, dest in adj.get(n, ())]
 
     def get_moves_for_nodes(self, nodes):
-        return sorted(list({t.on for t in self.transitions if t.source in nodes}))
+        adj = self.adjacency()
+        labels = self.labels
+        return {labels[on] for n in nodes for on, _ in adj.get(n, ())}
 
     def epsilon_closure(self, nodes):
-        fixed_point = [n for n in nodes]
-        new_eps = self.move_on(nodes, '')
-        while new_eps:
-            fixed_point.extend(new_eps)
-            new_eps = set(self.move_on(new_eps, '')) - set(fixed_point)
-
-        return fixed_point
+        if self._eps_closure is None:
+            self._eps_closure = self._compute_eps_closures()
+
+        return frozenset().union(*(self._eps_closure[n] for n in nodes))
+
+    def eps_closure_masks(self):
+        """Node -> epsilon closure as an int bitmask (bit n set for node n)"""
+        if self._eps_mask is None:
+            if self._eps_closure is None:
+                self._eps_closure = self._compute_eps_closures()
+
+            masks = {}
+            for n, closure in self._eps_closure.items():
+                mask = 0
+                for m in closure:
+                    mask |= 1 << m
+                masks[n] = mask
+            self._eps_mask = masks
+
+        return self._eps_mask
+
+    def _compute_eps_closures(self):
+        """Per-node epsilon closures, via Tarjan's SCC algorithm on the epsilon-only subgraph
+
+        Tarjan emits components in reverse topological order, so when a component is
+        popped every component it can reach already has its closure computed.
+        """
+        adj = self.adjacency()
+        all_nodes = set(self.src) | set(self.dst) | {self.start, self.term}
+        eps = {n: [dest for on, dest in adj.get(n, ()) if on == 0] for n in all_nodes}
+
+        closures = {}
+        index = {}
+        low = {}
+        stack = []
+        on_stack = set()
+
+        for root in all_nodes:
+            if root in index:
+                continue
+
+            index[root] = low[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            work = [(root, iter(eps[root]))]
+
+            while work:
+                node, succs = work[-1]
+                for succ in succs:
+                    if succ not in index:
+                        index[succ] = low[succ] = len(index)
+                        stack.append(succ)
+                        on_stack.add(succ)
+                        work.append((succ, iter(eps[succ])))
+                        break
+                    elif succ in on_stack:
+                        low[node] = min(low[node], index[succ])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        low[parent] = min(low[parent], low[node])
+
+                    if low[node] == index[node]:
+                        component = []
+                        while True:
+                            n = stack.pop()
+                            on_stack.discard(n)
+                            component.append(n)
+                            if n == node:
+                                break
+
+                        closure = set(component)
+                        for n in component:
+                            for succ in eps[n]:
+                                if succ in closures:
+                                    closure |= closures[succ]
+
+                        closure = frozenset(closure)
+                        for n in component:
+                            closures[n] = closure
+
+        return closures
 
     def move_on(self, nodes, on):
-        move_on = []
-        for t in self.transitions:
-            if t.on == on and t.source in nodes:
-                move_on.append(t.dest)
+        oid = self.alphabet.get(on)
+        if oid is None:
+            return frozenset()
 
-        return sorted(move_on)
+        adj = self.adjacency()
+        return frozenset(dest for n in nodes for t_on, dest in adj.get(n, ()) if t_on == oid)
 
     def closure(self, nodes, on):
-        extra_nodes = set()
-        for t in self.transitions:
-            if transition.on == on and transition.source in nodes:
-                extra_nodes.add(transition.dest)
-
-        return sorted(list(set(nodes) + extra_nodes))
+        return set(nodes) | self.move_on(nodes, on)
 
 
 
-    def prepend_new_start(self):
-        new_start = self.min_node()
-        self.add_offset(1)
-        self.transitions.append(
-            Transition('', new_start, self.start)
-        )
+    def prepend_new_start(self, states):
+        new_start = states.next()
+        self.add_transition('', new_start, self.start)
 
         self.start = new_start
 
-    def append_new_term(self):
-        new_term = self.max_node() + 1
-        old_term = self.term
-
-        self.transitions.append(
-            Transition('', old_term, new_term)
-        )
+    def append_new_term(self, states):
+        new_term = states.next()
+        self.add_transition('', self.term, new_term)
 
         self.term = new_term
 
-    def add_offset(self, offset):
-        self.start += offset
-        self.term += offset
-        for t in self.transitions:
-            t.source += offset
-            t.dest += offset
-
-    def replace_node(self, orig, new):
-        for t in self.transitions:
-            if t.source == orig:
-                t.source = new
-            if t.dest == orig:
-                t.dest = new
-
     @classmethod
-    def from_char(cls, char):
-        return cls([Transition(char, 0, 1)], 0, 1)
+    def from_char(cls, char, states=None):
+        states = states or StateAllocator()
+        start = states.next()
+        term = states.next()
+        return cls([Transition(char, start, term)], start, term)
 
     def concat(self, right):
-        offset = self.max_node()
-        if offset != self.term:
-            offset += 1
-
-        right.add_offset(offset)
-        right.replace_node(self.start, offset)
-
-        self.replace_node(self.term, offset)
+        # both sides were numbered by the same allocator, so just link them up
+        self.add_transition('', self.term, right.start)
         self.term = right.term
 
-        self.transitions.extend(right.transitions)
+        self.extend(right)
 
         return self
 
-    def disjunct(self, disjunct):
-        self.prepend_new_start()
-        new_start = self.start
+    def disjunct(self, disjunct, states):
+        self.prepend_new_start(states)
+        self.append_new_term(states)
+
+        self.add_transition('', self.start, disjunct.start)
+        self.add_transition('', disjunct.term, self.term)
 
-        old_term = self.term
-        self.append_new_term()
-        new_term = self.term
+        self.extend(disjunct)
 
-        offset = new_term + 1
+        return self
 
-        disjunct.add_offset(offset)
+    def zero_or_more(self, states):
+        # fresh start and term, so the loop back to the old start can't leak into
+        # paths that re-enter it from inside (e.g. the inner star in '(b*a)*')
+        new_start = states.next()
+        new_term = states.next()
 
-        self.transitions.append(
-            Transition('', new_start, disjunct.start)
-            )
-        
-        self.transitions.append(
-            Transition('', disjunct.term, new_term)
-            )
+        self.add_transition('', new_start, self.start)
+        self.add_transition('', self.term, self.start)
+        self.add_transition('', self.term, new_term)
+        self.add_transition('', new_start, new_term)
 
-        self.transitions.extend(disjunct.transitions)
+        self.start = new_start
+        self.term = new_term
 
         return self
 
-    def zero_or_more(self):
-        self.transitions.append(
-            Transition('', self.start, self.term)
-            )
-        self.transitions.append(
-            Transition('', self.term, self.start)
-            )
 
-        self.append_new_term()
-
-        return self
+class StateAllocator:
+    """Hands out NFA node ids, shared by every piece of one NFA so ids never collide"""
+    def __init__(self):
+        self.n = 0
 
+    def next(self):
+        n = self.n
+        self.n += 1
+        return n
 
 
 class RegexString:
     def __init__(self, s):
         self.s = s
+        self.n = len(s)
         self.i = 0
 
     def pop(self):
-        if self.is_eof():
+        i = self.i
+        if i >= self.n:
             return ""
 
-        c = self.s[self.i]
-        self.i += 1
-        return c
+        self.i = i + 1
+        return self.s[i]
 
     def pop_if(self, c):
-        if self.peek() == c:
-            self.pop()
+        if self.i < self.n and self.s[self.i] == c:
+            self.i += 1
             return True
 
         return False
 
     def peek(self):
-        if self.is_eof():
-            return ""
-
-        return self.s[self.i]
+        return self.s[self.i] if self.i < self.n else ""
 
     def is_eof(self):
-        return self.i == len(self.s)
+        return self.i >= self.n
 
     def push_back(self):
         self.i -= 1
@@ -295,8 +669,8 @@ class RegUnity:
 
             return False
 
-    def to_nfa(self):
-        return self.child.to_nfa()
+    def to_nfa(self, states=None):
+        return self.child.to_nfa(states)
 
     def __repr__(self):
         # return f"Unity({self.child})"
@@ -320,11 +694,11 @@ class RegChar:
             buf.push_back()
             return False
 
-    def to_nfa(self):
-        return NFA.from_char(self.child)
+    def to_nfa(self, states=None):
+        return NFA.from_char(self.child, states)
 
     def __repr__(self):
-        return f"[bold underline white]{self.child}[/bold underline white]"
+        return styled(self.child, "bold underline white")
 
 
 class RegGroup:
@@ -344,11 +718,11 @@ class RegGroup:
             buf.push_back()
             return False
 
-    def to_nfa(self):
-        return self.child.to_nfa()
+    def to_nfa(self, states=None):
+        return self.child.to_nfa(states)
 
     def __repr__(self):
-        return f"[purple]Group[/purple]( {self.child} )"
+        return f"{styled('Group', 'purple')}( {self.child} )"
 
 
 class RegQuality:
@@ -371,14 +745,18 @@ class RegQuality:
             qualifier = ''
         return cls(exp, qualifier)
     
-    def to_nfa(self):
-        child_nfa = self.child.to_nfa()
+    def to_nfa(self, states=None):
+        if states is None:
+            states = StateAllocator()
+
+        child_nfa = self.child.to_nfa(states)
         if self.qualifier == '':
             return child_nfa
         elif self.qualifier == '*':
-            return child_nfa.zero_or_more()
+            return child_nfa.zero_or_more(states)
         elif self.qualifier == '+':
-            rep_nfa = child_nfa.copy().zero_or_more()
+            # second copy built from the tree again so it gets its own node ids
+            rep_nfa = self.child.to_nfa(states).zero_or_more(states)
             child_nfa.concat(rep_nfa)
 
             return child_nfa
@@ -389,9 +767,9 @@ class RegQuality:
         if self.qualifier == '':
             return f"{self.child}"
         elif self.qualifier == '*':
-            return f"[red]ZeroOrMore[/red]( {self.child} )"
+            return f"{styled('ZeroOrMore', 'red')}( {self.child} )"
         elif self.qualifier == '+':
-            return f"[red]OneOrMore[/red]( {self.child} )"
+            return f"{styled('OneOrMore', 'red')}( {self.child} )"
         else:
             return f"UnknownQualifier( {self.child} )"
 
@@ -416,18 +794,21 @@ class RegConcat:
 
         return False
 
-    def to_nfa(self):
-        nfa = self.children[0].to_nfa()
+    def to_nfa(self, states=None):
+        if states is None:
+            states = StateAllocator()
+
+        nfa = self.children[0].to_nfa(states)
 
         for child in self.children[1:]:
-            nfa.concat(child.to_nfa())
+            nfa.concat(child.to_nfa(states))
 
         return nfa
 
     def __repr__(self):
         if len(self.children) > 1:
             s = ", ".join((f"{c}" for c in self.children))
-            return f"[green]Concat[/green]( {s} )"
+            return f"{styled('Concat', 'green')}( {s} )"
 
         return f"{self.children[0]}"
 
@@ -456,47 +837,168 @@ class RegDisj:
 
         return False
 
-    def to_nfa(self):
-        nfa = self.children[0].to_nfa()
+    def to_nfa(self, states=None):
+        if states is None:
+            states = StateAllocator()
+
+        nfa = self.children[0].to_nfa(states)
 
         for child in self.children[1:]:
-            nfa.disjunct(child.to_nfa())
+            nfa.disjunct(child.to_nfa(states), states)
 
         return nfa
 
     def __repr__(self):
         if len(self.children) > 1:
             s = ", ".join((f"{c}" for c in self.children))
-            return f"[blue]Disjunction[/blue]( {s} )"
+            return f"{styled('Disjunction', 'blue')}( {s} )"
 
         return f"{self.children[0]}"
 
 
+def write_parts(path, parts):
+    """Write string parts to a file with vectored writes, without joining them first"""
+    if not hasattr(os, "writev"):
+        # no writev (e.g. Windows)
+        with open(path, "w", encoding="utf-8") as f:
+            f.writelines(parts)
+        return
+
+    iov_max = os.sysconf("SC_IOV_MAX") if "SC_IOV_MAX" in os.sysconf_names else 1024
+    if iov_max <= 0:
+        # -1 means no fixed limit
+        iov_max = 1024
+    data = [p.encode() for p in parts]
+
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        i = 0
+        while i < len(data):
+            n = os.writev(fd, data[i:i + iov_max])
+            if n == 0 and any(data[i:i + iov_max]):
+                raise OSError(f"writev wrote nothing to {path}")
+            # skip whatever got written, short writes can stop partway through a part
+            while i < len(data) and n >= len(data[i]):
+                n -= len(data[i])
+                i += 1
+            if n:
+                data[i] = data[i][n:]
+    finally:
+        os.close(fd)
+
+
+@lru_cache(maxsize=256)
+def parse(pattern):
+    """Parse pattern to syntax tree, cached since the tree is never mutated"""
+    return RegexString(pattern).parse()
+
+
+def compile_nfa(pattern):
+    # NFAs get mutated while being combined, so build a fresh one from the cached tree
+    return parse(pattern).to_nfa()
+
+
+def compile_dfa(pattern):
+    return compile_nfa(pattern).to_dfa()
+
+
+@lru_cache(maxsize=256)
+def compile_matcher(pattern):
+    """Function that tests whether a whole string matches pattern"""
+    return compile_nfa(pattern).to_dfa(minimize=True).compile()
+
+
+# patterns for --check, compared against the re module on every short string
+CHECK_PATTERNS = (
+    "a(bc|d)*", "z+(a|b)", "ab*cd*", "a|b", "a|bc", "a|bc+", "a|(bc)+d",
+    "a*", "(ab)*", "(a|b)*abb", "a+b+", "(a*b*)*c", "((ab)|c)+d*",
+    "(b*a)*", "(a*b)*", "(b*a)+", "(a|b*)*c",
+)
+
+
+def self_check(patterns=CHECK_PATTERNS, max_len=5):
+    """Check DFAs and generated matchers against re.fullmatch, returns list of failures"""
+    failures = []
+    for pattern in patterns:
+        dfa = compile_dfa(pattern)
+        matchers = {
+            "dfa": dfa.compile(),
+            "minimized": dfa.minimize().compile(),
+            "compile_matcher": compile_matcher(pattern),
+        }
+        alphabet = sorted({c for c in pattern if c.isalnum()}) + ["x"]
+
+        for n in range(max_len + 1):
+            for chars in product(alphabet, repeat=n):
+                s = "".join(chars)
+                expected = re.fullmatch(pattern, s) is not None
+                for name, match in matchers.items():
+                    if match(s) != expected:
+                        failures.append((pattern, s, name, expected))
+
+    return failures
+
+
+def jit_check(patterns=CHECK_PATTERNS):
+    """Patterns whose DFA differs between the numba and pure-Python subset construction"""
+    if not HAVE_NUMBA:
+        return []
+
+    failures = []
+    jit_min_nodes = NFA.JIT_MIN_NODES
+    try:
+        for pattern in patterns:
+            NFA.JIT_MIN_NODES = 0
+            jit_dfa = compile_nfa(pattern).to_dfa()
+            NFA.JIT_MIN_NODES = 64
+            py_dfa = compile_nfa(pattern).to_dfa()
+
+            if repr(jit_dfa) != repr(py_dfa):
+                failures.append(pattern)
+    finally:
+        NFA.JIT_MIN_NODES = jit_min_nodes
+
+    return failures
+
 
 if __name__ == "__main__":
+    if "--check" in sys.argv[1:]:
+        failures = self_check()
+        for pattern, s, name, expected in failures:
+            builtins.print(f"{pattern!r} on {s!r}: {name} gave {not expected}, expected {expected}")
+
+        jit_failures = jit_check()
+        for pattern in jit_failures:
+            builtins.print(f"{pattern!r}: numba and pure-Python DFAs differ")
+
+        builtins.print(f"{len(failures) + len(jit_failures)} failures")
+        sys.exit(1 if failures or jit_failures else 0)
+
+    # rich parses every printed string for markup, skip it when nobody's looking
+    if "--plain" in sys.argv[1:] or not sys.stdout.isatty():
+        MARKUP = False
+        print = builtins.print
+
     strings = ("a(bc|d)*","z+(a|b)","ab*cd*", "a|b", "a|bc", "a|bc+", "a|(bc)+d")
     # strings = ("ab", "ab|cd", "abc*", "(ab)*", "abc+|d")
     # strings = ("a|(bc)+d",)
 
     for i,s in enumerate(strings):
-        parsed = RegexString(s).parse()
-        print(f"[bold underline]{s}[/bold underline]  --->  {parsed}")
+        parsed = parse(s)
+        print(f"{styled(s, 'bold underline')}  --->  {parsed}")
         print()
 
         nfa = parsed.to_nfa()
-        print(f"[bold]Nondeterministic finite automaton[/bold]")
+        print(styled("Nondeterministic finite automaton", "bold"))
         print(nfa)
         print()
 
         dfa = nfa.to_dfa()
-        print(f"[bold]Deterministic finite automaton[/bold]")
+        print(styled("Deterministic finite automaton", "bold"))
         print(dfa)
         print()
 
-        with open(f"nfa{i}.gv", "w") as f:
-            f.write(nfa.to_graphviz(s))
-
-        with open(f"dfa{i}.gv", "w") as f:
-            f.write(dfa.to_graphviz(s))
+        write_parts(f"nfa{i}.gv", nfa.graphviz_parts(s))
+        write_parts(f"dfa{i}.gv", dfa.graphviz_parts(s))
 
 